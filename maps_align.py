@@ -1,7 +1,12 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import threading
+
 import rasterio
+import rasterio.shutil
 from rasterio.windows import Window
 from rasterio.vrt import WarpedVRT
-from rasterio.warp import Resampling
+from rasterio.warp import Resampling, calculate_default_transform
 import numpy as np
 
 # Paths to input files
@@ -14,50 +19,154 @@ elevation_aligned_path = r'C:\Users\Ildar\Desktop\Moonpol\data prep\test3\elevat
 slope_aligned_path     = r'C:\Users\Ildar\Desktop\Moonpol\data prep\test3\slope_aligned.tif'
 # The mineral map remains unchanged
 
-print("Reading target parameters from the mineral map...")
-with rasterio.open(minerals_path) as mineral_src:
-    target_crs = mineral_src.crs
-    target_transform = mineral_src.transform
-    target_width = mineral_src.width
-    target_height = mineral_src.height
-    print("Target CRS:", target_crs)
-    print("Target GeoTransform:", target_transform)
-    print(f"Target size: {target_width} x {target_height}")
-
-def reproject_raster(src_path, dst_path, target_crs, target_transform, target_width, target_height, block_size=1024):
-    """Reproject the raster using tile-based processing"""
-    with rasterio.open(src_path) as src:
+# GDAL settings for every file access: a larger block cache (per process; two workers run at once),
+# multithreaded warping, no directory listing on open and cached file reads
+GDAL_OPTIONS = dict(GDAL_CACHEMAX=2048, GDAL_NUM_THREADS='ALL_CPUS',
+                    GDAL_DISABLE_READDIR_ON_OPEN='TRUE', VSI_CACHE='TRUE')
+
+def write_block(dst, window, future):
+    """Write the array produced by a pending read into its window of dst"""
+    dst.write(future.result(), window=window)
+    print(f"Processed block at (x={window.col_off}, y={window.row_off}) with size ({window.width} x {window.height}) for file {dst.name}")
+
+def block_buffer(flat, count, window):
+    """C-contiguous (count, height, width) view over the front of a flat reusable buffer"""
+    return flat[:count * window.height * window.width].reshape(count, window.height, window.width)
+
+def overview_level_for(src, target_crs, target_transform):
+    """Index of the coarsest overview that is still at least as fine as the target grid, or None"""
+    # Native source resolution expressed in target CRS units
+    native_transform, _, _ = calculate_default_transform(src.crs, target_crs, src.width, src.height, *src.bounds)
+    decimation = abs(target_transform.a) / abs(native_transform.a)
+    level = None
+    for i, factor in enumerate(src.overviews(1)):
+        if factor <= decimation:
+            level = i
+    return level
+
+def reproject_raster(src_path, dst_path, target_crs, target_transform, target_width, target_height, block_size=1024, prefetch=4, readers=2, resampling=Resampling.bilinear, in_memory_limit=1024 ** 3):
+    """Reproject the raster using tile-based processing, overlapping VRT reads with output writes.
+
+    Use the default bilinear resampling for continuous fields (elevation, slope) and
+    Resampling.nearest for categorical rasters such as the mineral map. Outputs of at most
+    in_memory_limit bytes are warped in a single read instead of block by block.
+    """
+    # Environment settings don't carry over to worker processes, so each call sets its own
+    with rasterio.Env(**GDAL_OPTIONS), rasterio.open(src_path) as src:
+        # Tiled, compressed layout for fast windowed access; floating point predictor for float data
+        creation_options = {
+            'driver': 'GTiff',  # Save as GeoTIFF, change if necessary
+            'tiled': True,
+            'blockxsize': 512,
+            'blockysize': 512,
+            'compress': 'zstd',
+            'predictor': 3 if np.issubdtype(np.dtype(src.dtypes[0]), np.floating) else 2,
+            'BIGTIFF': 'IF_SAFER',
+            'num_threads': 'ALL_CPUS'
+        }
+        
+        # Already on the target grid: nothing to resample, just copy the pixels (and overviews) across
+        if (src.crs == target_crs and src.transform.almost_equals(target_transform)
+                and src.width == target_width and src.height == target_height):
+            print(f"\nSource already matches the target grid, copying to: {dst_path}")
+            rasterio.shutil.copy(src, dst_path, COPY_SRC_OVERVIEWS='YES', **creation_options)
+            print(f"Copy complete for file: {src_path} -> {dst_path}")
+            return
+        
         profile = src.profile.copy()
         profile.update({
             'crs': target_crs,
             'transform': target_transform,
             'width': target_width,
             'height': target_height,
-            'driver': 'GTiff'  # Save as GeoTIFF, change if necessary
+            **creation_options
         })
+        # Square windows made of whole 512x512 output tiles, so each write fills complete tiles and each
+        # VRT read only warps the source blocks under that window instead of a full-width strip
+        block_size = -(-block_size // 512) * 512
+        # A coarser target only needs the matching overview, not every full-resolution source block
+        overview_level = overview_level_for(src, target_crs, target_transform)
+        open_options = {}
+        if overview_level is not None:
+            print(f"Reading source from overview level {overview_level}")
+            open_options['overview_level'] = overview_level
+        
+        # GDAL dataset handles must not be read from several threads, so every reader thread warps through
+        # its own unshared source handle and WarpedVRT, opened on first use and closed once all reads are done
+        local = threading.local()
+        handles = []
+        handles_lock = threading.Lock()
+        
+        def read_block(window, out):
+            with rasterio.Env(**GDAL_OPTIONS):
+                if not hasattr(local, 'vrt'):
+                    thread_src = rasterio.open(src_path, sharing=False, **open_options)
+                    local.vrt = WarpedVRT(thread_src,
+                                          crs=target_crs,
+                                          transform=target_transform,
+                                          width=target_width,
+                                          height=target_height,
+                                          resampling=resampling)
+                    with handles_lock:
+                        handles.extend((local.vrt, thread_src))
+                return local.vrt.read(out=out, window=window)
+        
         print(f"\nCreating output file: {dst_path}")
-        with rasterio.open(dst_path, 'w', **profile) as dst:
-            # Use WarpedVRT for reprojection with the given parameters
-            with WarpedVRT(src,
-                           crs=target_crs,
-                           transform=target_transform,
-                           width=target_width,
-                           height=target_height,
-                           resampling=Resampling.nearest) as vrt:
-                for row in range(0, target_height, block_size):
-                    num_rows = min(block_size, target_height - row)
-                    window = Window(0, row, target_width, num_rows)
-                    data = vrt.read(window=window)
-                    dst.write(data, window=window)
-                    print(f"Processed rows {row} - {row + num_rows} for file {dst_path}")
+        try:
+            with rasterio.open(dst_path, 'w', **profile) as dst:
+                # Small outputs fit in memory: one warp over the whole grid skips the per-window overhead
+                if target_width * target_height * profile['count'] * np.dtype(profile['dtype']).itemsize <= in_memory_limit:
+                    window = Window(0, 0, target_width, target_height)
+                    dst.write(read_block(window, None), window=window)
+                    print(f"Processed whole raster in one read for file {dst_path}")
+                else:
+                    # One reusable buffer per read that can be in flight: a block's buffer is only handed out
+                    # again after that block has been written
+                    buffers = [np.empty(profile['count'] * block_size * block_size, dtype=profile['dtype'])
+                               for _ in range(prefetch + 1)]
+                    # Reader threads warp up to `prefetch` blocks ahead while this thread writes them in order,
+                    # so reads and writes overlap and only one thread ever touches dst
+                    with ThreadPoolExecutor(max_workers=readers) as pool:
+                        pending = deque()
+                        num_blocks = 0
+                        for row in range(0, target_height, block_size):
+                            num_rows = min(block_size, target_height - row)
+                            for col in range(0, target_width, block_size):
+                                num_cols = min(block_size, target_width - col)
+                                window = Window(col, row, num_cols, num_rows)
+                                out = block_buffer(buffers[num_blocks % len(buffers)], profile['count'], window)
+                                num_blocks += 1
+                                pending.append((window, pool.submit(read_block, window, out)))
+                                if len(pending) > prefetch:
+                                    write_block(dst, *pending.popleft())
+                        while pending:
+                            write_block(dst, *pending.popleft())
+        finally:
+            for handle in handles:
+                handle.close()
     print(f"Reprojection complete for file: {src_path} -> {dst_path}")
 
-print("\nStarting reprojection of the elevation map...")
-reproject_raster(elevation_path, elevation_aligned_path, target_crs, target_transform, target_width, target_height, block_size=1024)
-print("\nElevation map reprojected and saved.")
+# Worker processes re-import this module (spawn on Windows), so the pipeline only runs in the parent
+if __name__ == '__main__':
+    print("Reading target parameters from the mineral map...")
+    with rasterio.Env(**GDAL_OPTIONS), rasterio.open(minerals_path) as mineral_src:
+        target_crs = mineral_src.crs
+        target_transform = mineral_src.transform
+        target_width = mineral_src.width
+        target_height = mineral_src.height
+        print("Target CRS:", target_crs)
+        print("Target GeoTransform:", target_transform)
+        print(f"Target size: {target_width} x {target_height}")
 
-print("\nStarting reprojection of the slope map...")
-reproject_raster(slope_path, slope_aligned_path, target_crs, target_transform, target_width, target_height, block_size=1024)
-print("\nSlope map reprojected and saved.")
+    # Elevation and slope are independent, so each is reprojected in its own process with its own GDAL handles
+    print("\nStarting reprojection of the elevation and slope maps...")
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        jobs = {
+            pool.submit(reproject_raster, elevation_path, elevation_aligned_path, target_crs, target_transform, target_width, target_height, block_size=1024): "Elevation",
+            pool.submit(reproject_raster, slope_path, slope_aligned_path, target_crs, target_transform, target_width, target_height, block_size=1024): "Slope",
+        }
+        for job in as_completed(jobs):
+            job.result()
+            print(f"\n{jobs[job]} map reprojected and saved.")
 
-print("\nProcessing complete. All aligned files have been saved.")
+    print("\nProcessing complete. All aligned files have been saved.")